@@ -21,16 +21,137 @@
 # ------------------------------------------------------------------------------
 
 from datetime import timedelta
+from functools import lru_cache
+from operator import itemgetter
+from pathlib import Path
 
-import netCDF4 as nc
 import numpy as np
+import shapely
+import xarray as xr
+from numba import njit
 from orbit_predictor.sources import get_predictor_from_tle_lines
-from shapely import speedups
-from shapely.geometry import Point
-from utils.generic_functions import (geo_idx, init_orbit_poly,
-                                     quick_cal_daylight)
+from utils.generic_functions import init_orbit_poly, quick_cal_daylight
 
-speedups.disable()
+
+@njit(cache=True)
+def points_in_polys(lats, lons, polys, nverts):
+    """ Ray casting point in polygon test of every point against every polygon.
+        lats: latitudes of the points
+        lons: longitudes of the points
+        polys: (n_polys, max_verts, 2) lon, lat vertices of the polygon exteriors
+        nverts: number of vertices of each polygon
+
+        return: (n_points, n_polys) boolean mask, True where point is inside polygon
+    """
+    n_pts = lats.shape[0]
+    n_polys = polys.shape[0]
+    mask = np.zeros((n_pts, n_polys), dtype=np.bool_)
+    for i in range(n_pts):
+        x = lons[i]
+        y = lats[i]
+        for j in range(n_polys):
+            inside = False
+            k = nverts[j] - 1
+            for m in range(nverts[j]):
+                xm, ym = polys[j, m, 0], polys[j, m, 1]
+                xk, yk = polys[j, k, 0], polys[j, k, 1]
+                # flip for each polygon edge crossed by a ray cast east of the point
+                if (ym > y) != (yk > y) and x < (xk - xm) * (y - ym) / (yk - ym) + xm:
+                    inside = not inside
+                k = m
+            mask[i, j] = inside
+    return mask
+
+
+def _poly_coords(polys):
+    """ Pack polygon exteriors into a padded (n_polys, max_verts, 2) vertex
+        array and the number of vertices of each polygon, for points_in_polys.
+    """
+    # drop the closing vertex of each exterior ring
+    exteriors = [np.asarray(p.exterior.coords)[:-1] for p in polys]
+    nverts = np.array([len(e) for e in exteriors], dtype=np.int64)
+    coords = np.zeros((len(exteriors), nverts.max(), 2), dtype=np.float64)
+    for i, e in enumerate(exteriors):
+        coords[i, :len(e)] = e
+    return coords, nverts
+
+
+@lru_cache(maxsize=4)
+def _load_cloud_cover(weather_path, block=720):
+    """ Load the cloud cover (time, lat, lon) of a weather file as whole percents
+        (uint8, 0-100). Decoded in blocks of time steps to avoid a full float copy,
+        and cached so crews share a single array. Missing values are treated as
+        fully covered.
+    """
+    with xr.open_dataset(weather_path) as ds:
+        tcc = ds['tcc']
+        cloud_pct = np.empty(tcc.shape, dtype=np.uint8)
+        for t0 in range(0, tcc.shape[0], block):
+            cc = np.nan_to_num(tcc[t0:t0 + block].values, nan=1.0)
+            cloud_pct[t0:t0 + block] = np.rint(np.clip(cc, 0, 1) * 100)
+    return cloud_pct
+
+
+# Parsed TLE files, {absolute path: {satellite label: (line 1, line 2)}}
+_TLE_CACHE = {}
+
+
+def _load_tles(tle_path):
+    """ Read a TLE file once per process and return the two line elements
+        of every satellite in it, keyed by satellite label.
+    """
+    tle_path = str(Path(tle_path).resolve())
+    if tle_path in _TLE_CACHE:
+        return _TLE_CACHE[tle_path]
+    with open(tle_path) as f:
+        TLEs = [line.rstrip() for line in f]
+    tles = {}
+    for i in range(len(TLEs) - 2):
+        if TLEs[i+1].startswith('1 ') and TLEs[i+2].startswith('2 '):
+            tles.setdefault(TLEs[i], (TLEs[i+1], TLEs[i+2]))
+    _TLE_CACHE[tle_path] = tles
+    return tles
+
+
+@lru_cache(maxsize=None)
+def _load_predictor(tle_path, sat_label):
+    """ Build the orbit predictor of a satellite from a TLE file. Cached so
+        crews sharing a satellite only build the predictor once.
+    """
+    TLE_LINES = _load_tles(tle_path)[sat_label]
+    return get_predictor_from_tle_lines(TLE_LINES)
+
+
+@lru_cache(maxsize=4)
+def _compute_orbit_path(tle_path, sat_label, T1, T2, interval):
+    """ Calculate the orbit path polygons of a satellite between T1 and T2.
+        Cached so crews sharing a satellite only build the path once, bounded as
+        pool workers run many simulations in turn.
+
+        return: poly_coords_by_date: {date: (vertices, n vertices) of the daily
+                                      orbit path polygons}, for dates where all
+                                      polygons are valid
+                orbit_trees: {date: STRtree of the daily orbit path polygons}, for
+                              the remaining dates
+    """
+    predictor = _load_predictor(tle_path, sat_label)
+    sat_datetime, orbit_path = init_orbit_poly(predictor, T1, T2, interval)
+    # bucket the pathes by date in a single pass
+    polys_by_date = {}
+    for sat_dt, poly in zip(sat_datetime, orbit_path):
+        polys_by_date.setdefault(sat_dt.date(), []).append(poly)
+    polys_by_date = {date: np.array(polys, dtype=object)
+                     for date, polys in polys_by_date.items()}
+    # vertices of valid daily pathes for the compiled point in polygon test, and
+    # a spatial index of the others, satellite path is static through the simulation
+    poly_coords_by_date = {}
+    orbit_trees = {}
+    for date, polys in polys_by_date.items():
+        if shapely.is_valid(polys).all():
+            poly_coords_by_date[date] = _poly_coords(polys)
+        else:
+            orbit_trees[date] = shapely.STRtree(polys)
+    return poly_coords_by_date, orbit_trees
 
 
 class Schedule():
@@ -45,13 +166,29 @@ class Schedule():
         self.start_hour = 0
         self.end_hour = 23
         self.allowed_end_time = None
+        self.rng = np.random.default_rng()
 
         # extract cloud cover data
         input_directory = self.parameters['input_directory']
         cloud = self.parameters['weather_file']
-        Dataset = nc.Dataset(input_directory / cloud, 'r')
-        self.cloudcover = Dataset.variables['tcc'][:]
-        Dataset.close()
+        self.cloudcover = _load_cloud_cover(input_directory / cloud)
+        # weather grid used to locate sites in the cloud cover data, sorted
+        # for binary search along with the order to map back to grid indices
+        lat_grid = np.asarray(self.state['weather'].latitude, dtype=np.float64)
+        lon_grid = np.asarray(self.state['weather'].longitude, dtype=np.float64)
+        self._lat_order = np.argsort(lat_grid, kind='stable')
+        self._lon_order = np.argsort(lon_grid, kind='stable')
+        self._lat_sorted = np.ascontiguousarray(lat_grid[self._lat_order])
+        self._lon_sorted = np.ascontiguousarray(lon_grid[self._lon_order])
+        # boundaries half way between grid cells, the nearest cell of a
+        # value is the number of boundaries below it
+        self._lat_mid = (self._lat_sorted[1:] + self._lat_sorted[:-1]) / 2
+        self._lon_mid = (self._lon_sorted[1:] + self._lon_sorted[:-1]) / 2
+        # like geo_idx, break ties at a boundary toward the lower grid index,
+        # which is the upper sorted cell for descending grids (e.g. ERA5 latitude)
+        self._lat_side = 'right' if lat_grid[0] > lat_grid[-1] else 'left'
+        self._lon_side = 'right' if lon_grid[0] > lon_grid[-1] else 'left'
+        self._lon_360 = self._lon_sorted[-1] > 180
         # obtain TLE file path
         self.sat = self.config['TLE_label']
         self.tlefile = self.config['TLE_file']
@@ -68,20 +205,30 @@ class Schedule():
         # Set start of work, satellite can work 24 hours per day
         self.state['t'].current_date = self.state['t'].current_date.replace(
             hour=int(1))
+        if self.parameters['seed_timeseries']:
+            # Seed from the daily seeded numpy RNG so runs stay reproducible
+            self.rng = np.random.default_rng(np.random.randint(np.iinfo(np.int32).max))
+
+        # gather site coordinates once for the day, (n_sites, [lat, lon])
+        get_ll = itemgetter('lat', 'lon')
+        site_ll = np.fromiter(
+            (c for s in site_pool for c in get_ll(s)), dtype=np.float64,
+            count=2 * len(site_pool)).reshape(-1, 2)
 
         # find out the site that can be seen by satellite
-        viewable_sites = self.calc_viewable_sites(site_pool)
+        viewable_idx = self.calc_viewable_sites(site_ll)
+        viewable_sites = [site_pool[i] for i in viewable_idx]
         if len(viewable_sites) == 0:
             self.worked_today = False
             daily_site_plans = []
+        elif not self.parameters['consider_weather']:
+            daily_site_plans = [self.plan_visit(site) for site in viewable_sites]
         # check daylight and cloud_cover for each site inside the site pool
         else:
-            daily_site_plans = []
-            for site in viewable_sites:
-                sat_dl, sat_cc = self.assess_weather(site)
-                if (sat_dl and sat_cc) or not self.parameters['consider_weather']:
-                    plan = self.plan_visit(site)
-                    daily_site_plans.append(plan)
+            sat_weather = self.assess_weather_batch(site_ll[viewable_idx])
+            daily_site_plans = [
+                self.plan_visit(site) for site, sat_wt in zip(viewable_sites, sat_weather)
+                if sat_wt]
 
         return daily_site_plans
 
@@ -106,71 +253,79 @@ class Schedule():
             'remaining_mins': 0,
         }
 
-    def calc_viewable_sites(self, site_pool):
+    def calc_viewable_sites(self, site_ll):
         """Generic utility function to check whether a satellite can see
-           a given patch of ground. Returns True to denote the satellite
-           can see the location and False otherwise.
+           a given patch of ground.
            Args:
-               site: a site
+               site_ll: (n_sites, 2) array of site latitudes and longitudes
 
            Returns:
-               valid_site: boolean
+               numpy.ndarray: indices of the sites within the daily orbit pathes
         """
-        valid_site = []
-        # ind = 0
-        sat_date = self.sat_date
-        path = self.orbit_path
         date = self.state['t'].current_date.date()
         # find daily pathes
-        DP = path[sat_date == date]
-        for s in site_pool:
-            fac_lat = np.float16(s['lat'])
-            fac_lon = np.float16(s['lon'])
-            PT = Point(fac_lon, fac_lat)
-            for dp in DP:
-                if dp.contains(PT):
-                    valid_site.append(s)
-                    break
-        return valid_site
-
-    def assess_weather(self, site):
-        """Check whether the site is covered by clound or have enough daylight
+        poly_coords = self.poly_coords_by_date.get(date)
+        tree = self.orbit_trees.get(date)
+        if (poly_coords is None and tree is None) or len(site_ll) == 0:
+            return np.empty(0, dtype=np.intp)
+        lats = np.ascontiguousarray(site_ll[:, 0])
+        lons = np.ascontiguousarray(site_ll[:, 1])
+        # a site is viewable if it falls within any of the daily pathes
+        if poly_coords is not None:
+            mask = points_in_polys(lats, lons, *poly_coords)
+            return np.flatnonzero(mask.any(axis=1))
+        # fall back to the spatial index for invalid (self intersecting) pathes
+        pts = shapely.points(lons, lats)
+        idx = tree.query(pts, predicate='within')
+        return np.unique(idx[0])
+
+    def assess_weather_batch(self, site_ll):
+        """Check whether each site is covered by cloud or has enough
+           daylight, in a single pass over all sites.
             Args:
-             site: a site
+             site_ll: (n_sites, 2) array of site latitudes and longitudes
 
             Returns:
-                valid_site: boolean
+                numpy.ndarray: boolean mask, True where a site has daylight
+                               and is not covered by cloud
         """
-
-        site_lat = np.float16(site['lat'])
-        site_lon = np.float16(site['lon'])
-
-        lat_idx = geo_idx(site_lat, self.state['weather'].latitude)
-        lon_idx = geo_idx(site_lon, self.state['weather'].longitude)
-        ti = self.state['t'].current_timestep
-
         # check daylight
         date = self.state['t'].current_date
-        sr, ss = quick_cal_daylight(date, site_lat, site_lon)
+        sat_weather = np.array([
+            sr <= date.hour <= ss for sr, ss in (
+                quick_cal_daylight(date, lat, lon) for lat, lon in site_ll.tolist())],
+            dtype=bool)
+        # check cloud cover only for sites with daylight, sites are clear
+        # with probability of 1 - cloud cover
+        dl_idx = np.flatnonzero(sat_weather)
+        if len(dl_idx) == 0:
+            return sat_weather
+        lat_idx, lon_idx = self.locate_sites(site_ll[dl_idx])
+        ti = self.state['t'].current_timestep
+        CC = self.cloudcover[ti, lat_idx, lon_idx]
+        sat_weather[dl_idx] = self.rng.integers(100, size=len(dl_idx)) >= CC
 
-        if sr <= self.state['t'].current_date.hour <= ss:
-            sat_daylight = True
-        else:
-            sat_daylight = False
-        # check cloud cover
+        return sat_weather
 
-        CC = self.cloudcover[ti, lat_idx, lon_idx] * 100
-        CC = round(CC)
-        arr = np.zeros(100)
-        arr[:CC] = 1
-        np.random.shuffle(arr)
+    def locate_sites(self, site_ll):
+        """Find the nearest weather grid cell of each site.
+            Args:
+             site_ll: (n_sites, 2) array of site latitudes and longitudes
 
-        if np.random.choice(arr, 1)[0] == 0:
-            sat_cc = True
+            Returns:
+                tuple: (lat_idx, lon_idx) arrays of weather grid indices
+        """
+        # bring site longitudes to the grid convention, [0, 360) or [-180, 180)
+        lons = site_ll[:, 1]
+        if self._lon_360:
+            lons = np.where(lons < 0, lons + 360, lons)
         else:
-            sat_cc = False
-
-        return (sat_daylight, sat_cc)
+            lons = np.where(lons >= 180, lons - 360, lons)
+        lat_idx = self._lat_order[
+            np.searchsorted(self._lat_mid, site_ll[:, 0], side=self._lat_side)]
+        lon_idx = self._lon_order[
+            np.searchsorted(self._lon_mid, lons, side=self._lon_side)]
+        return lat_idx, lon_idx
 
     def get_orbit_predictor(self):
         """ Get the orbit predictor of satellite based on
@@ -178,17 +333,7 @@ class Schedule():
         """
         # build a satellite orbit object
         input_directory = self.parameters['input_directory']
-        TLEs = []
-        with open(input_directory / self.tlefile) as f:
-            for line in f:
-                TLEs.append(line.rstrip())
-        i = 0
-        for x in TLEs:
-            if x == self.sat:
-                break
-            i += 1
-        TLE_LINES = (TLEs[i+1], TLEs[i+2])
-        self.predictor = get_predictor_from_tle_lines(TLE_LINES)
+        self.predictor = _load_predictor(input_directory / self.tlefile, self.sat)
         return
 
     def get_orbit_path(self):
@@ -199,12 +344,9 @@ class Schedule():
         T1 = self.state['t'].start_date
         T2 = self.state['t'].end_date
         # calculate the orbit path polygon for satellite
-        self.sat_datetime, self.orbit_path = init_orbit_poly(
-            self.predictor, T1, T2, 15)
-        self.sat_date = [d.date() for d in self.sat_datetime]
-
-        self.sat_date = np.array(self.sat_date)
-        self.orbit_path = np.array(self.orbit_path)
+        input_directory = self.parameters['input_directory']
+        self.poly_coords_by_date, self.orbit_trees = _compute_orbit_path(
+            input_directory / self.tlefile, self.sat, T1, T2, 15)
 
         return
 
@@ -28,8 +28,8 @@ from pathlib import Path
 import boto3
 import ephem
 import numpy as np
+import shapely
 from botocore.exceptions import ClientError
-from shapely.geometry import Polygon
 
 
 def gap_calculator(condition_vector):
@@ -216,10 +216,10 @@ def init_orbit_poly(predictor, T1, T2, interval):
     interval: time interval of each time step in minutes
 
     return: day_list: date time of the satellite
-            polygon_list: coverage area polygon of the satellite
+            polygon_list: array of coverage area polygons of the satellite
 
     """
-    polygon_list = []
+    coords = []
     day_list = []
     while T1 != T2:
         # obtain the position info of the satellite
@@ -242,11 +242,12 @@ def init_orbit_poly(predictor, T1, T2, interval):
         pt3 = (lon2, lat2-0.1)
         pt4 = (lon2-0.1, lat2)
 
-        # create that coverage area polygon
-        polygon3 = Polygon([pt1, pt2, pt3, pt4])
-        polygon_list.append(polygon3)
+        coords.append([pt1, pt2, pt3, pt4])
         day_list.append(T1)
 
         T1 += datetime.timedelta(minutes=interval)
 
+    # create all coverage area polygons at once, (n_steps, 4 corners, [lon, lat])
+    polygon_list = shapely.polygons(np.asarray(coords, dtype=np.float64).reshape(-1, 4, 2))
+
     return day_list, polygon_list